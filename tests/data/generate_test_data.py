@@ -5,203 +5,273 @@ import os
 import pysam
 import numpy as np
 import argparse
+import multiprocessing
 from collections import defaultdict
 
+# Every synthetic read is a full-length 75bp match (75M) at MAPQ 60
+_READ_LEN = 75
+_MAPQ = 60
+_CIGAR = f"{_READ_LEN}M"
+# 99 = paired, mapped, first in pair; 147 = paired, mapped, second in pair, reverse strand
+_FLAG_READ1 = 99
+_FLAG_READ2 = 147
+
+# Sample BAMs get this many extra read pairs piled into every peak
+_READS_PER_PEAK = 200
+# Fragment lengths are shorter inside peaks for more precise peaks
+_PEAK_TLEN_RANGE = (50, 100)
+_BACKGROUND_TLEN_RANGE = (50, 150)
+
+# Recorded as the @PG VN; bump whenever the read model changes so that
+# --reuse never picks up BAMs made by an older generator
+_GENERATOR_VERSION = '2.0'
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Generate synthetic BAM file for testing')
     parser.add_argument('--output', default='test_sample.bam', help='Output BAM file')
     parser.add_argument('--control', default='test_control.bam', help='Output control BAM file')
     parser.add_argument('--reads', type=int, default=1000, help='Number of reads to generate')
     parser.add_argument('--peaks', type=int, default=5, help='Number of peaks to generate')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducible output')
+    parser.add_argument('--reuse', action='store_true',
+                        help='Reuse existing BAMs made by this generator version with the same settings and --seed')
+    parser.add_argument('--no-index', dest='index', action='store_false',
+                        help='Skip building .bai indexes (sbpc needs one for the sample BAM)')
     return parser.parse_args()
 
-def create_header():
+def create_header(command_line=None):
     """Create a simple header with a few chromosomes."""
     header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
               'SQ': [{'LN': 10000, 'SN': 'chr1'},
                      {'LN': 8000, 'SN': 'chr2'},
                      {'LN': 5000, 'SN': 'chr3'}],
-              'PG': [{'ID': 'synthetic', 'PN': 'synthetic.py', 'VN': '1.0'}]}
+              'PG': [{'ID': 'synthetic', 'PN': 'synthetic.py', 'VN': _GENERATOR_VERSION}]}
+    if command_line is not None:
+        header['PG'][0]['CL'] = command_line
     return header
 
-def generate_peak_regions(num_peaks, header):
+def is_cached(filename, command_line, index=True):
+    """Check whether a BAM (and its index, if wanted) was already generated by the same command line.
+    
+    The command line includes the --role the file was generated for, so a
+    sample BAM is never picked up as a control or vice versa. BAMs from a
+    different generator version are never reused.
+    """
+    if not os.path.exists(filename) or (index and not os.path.exists(filename + ".bai")):
+        return False
+    try:
+        with pysam.AlignmentFile(filename, "rb") as bam:
+            programs = bam.header.to_dict().get('PG', [])
+    except (OSError, ValueError):
+        return False
+    return any(pg.get('VN') == _GENERATOR_VERSION and pg.get('CL') == command_line for pg in programs)
+
+def generate_peak_regions(num_peaks, header, rng):
     """Generate random peak regions."""
-    peaks = []
+    chrom_names = header.references
+    chrom_lens = np.array(header.lengths)
     
-    chrom_assignments = np.random.choice(len(header['SQ']), num_peaks)
+    chrom_idx = rng.integers(0, header.nreferences, size=num_peaks)
+    lens = chrom_lens[chrom_idx]
     
-    for i in range(num_peaks):
-        chrom_idx = chrom_assignments[i]
-        chrom = header['SQ'][chrom_idx]['SN']
-        chrom_len = header['SQ'][chrom_idx]['LN']
-        
-        width = 200  # Fixed width for more consistent peaks
-        
-        section_size = chrom_len // (num_peaks + 1)
-        section_start = section_size * (i % (num_peaks + 1))
+    width = 200  # Fixed width for more consistent peaks
+    
+    section_size = lens // (num_peaks + 1)
+    section_start = section_size * (np.arange(num_peaks) % (num_peaks + 1))
+    
+    max_start = np.minimum(section_start + section_size - width, lens - width)
+    max_start = np.clip(max_start, 2, None)
+    
+    starts = rng.integers(1, max_start)
+    ends = starts + width
+    
+    return [(chrom_names[i], start, end)
+            for i, start, end in zip(chrom_idx.tolist(), starts.tolist(), ends.tolist())]
+
+def _draw_peak_positions(rng, peak_starts, peak_ends):
+    """Draw one read start per entry, normally around the peak centre and clipped to [start, end - 100]."""
+    peak_centers = (peak_starts + peak_ends) // 2
+    peak_widths = peak_ends - peak_starts
+    offsets = rng.normal(0, 1, size=len(peak_starts)) * (peak_widths / 6)
+    return np.clip(peak_centers + offsets, peak_starts, peak_ends - 100).astype(np.int64)
+
+def _generate_peak_reads(rng, peaks, reads_per_peak, header, first_id, tlen_range):
+    """Generate a fixed number of read pairs inside every peak."""
+    num_reads = len(peaks) * reads_per_peak
+    peak_idx = np.repeat(np.arange(len(peaks)), reads_per_peak)
+    
+    peak_tids = np.array([header.get_tid(chrom) for chrom, _, _ in peaks], dtype=np.int64)
+    peak_starts = np.array([start for _, start, _ in peaks], dtype=np.int64)
+    peak_ends = np.array([end for _, _, end in peaks], dtype=np.int64)
+    
+    names = [f"peak_read_{first_id + i}_1" for i in range(num_reads)]
+    ref_ids = peak_tids[peak_idx]
+    positions = _draw_peak_positions(rng, peak_starts[peak_idx], peak_ends[peak_idx])
+    tlens = rng.integers(*tlen_range, size=num_reads)
+    
+    return names, ref_ids, positions, tlens
+
+def _generate_background_reads(rng, num_reads, peaks, peak_prob, header, tlen_range, peak_tlen_range):
+    """Generate read pairs spread over the genome, a peak_prob fraction of them inside peaks."""
+    chrom_lens = np.array(header.lengths)
+    
+    in_peak = rng.random(num_reads) < peak_prob
+    ref_ids = rng.integers(0, header.nreferences, size=num_reads)
+    positions = rng.integers(1, np.maximum(2, chrom_lens - 200)[ref_ids])
+    tlens = rng.integers(*tlen_range, size=num_reads)
+    
+    if peaks:
+        peak_tids = np.array([header.get_tid(chrom) for chrom, _, _ in peaks])
+        peak_starts = np.array([start for _, start, _ in peaks])
+        peak_ends = np.array([end for _, _, end in peaks])
         
-        max_start = min(section_start + section_size - width, chrom_len - width)
-        if max_start <= 0:
-            max_start = 1
-            
-        start = np.random.randint(1, max_start)
-        end = start + width
+        peak_idx = rng.integers(0, len(peaks), size=num_reads)
+        peak_pos = _draw_peak_positions(rng, peak_starts[peak_idx], peak_ends[peak_idx])
+        peak_tlen = rng.integers(*peak_tlen_range, size=num_reads)
         
-        peaks.append((chrom, start, end))
+        ref_ids = np.where(in_peak, peak_tids[peak_idx], ref_ids)
+        positions = np.where(in_peak, peak_pos, positions)
+        tlens = np.where(in_peak, peak_tlen, tlens)
     
-    return peaks
+    names = [f"read_{i}_1" for i in range(num_reads)]
+    
+    return names, ref_ids, positions, tlens
 
-def generate_reads(num_reads, peaks, header, is_control=False):
-    """Generate random reads, with enrichment in peak regions for sample."""
-    reads = []
+def generate_reads(num_reads, peaks, header, rng, is_control=False):
+    """Generate random read pairs, with enrichment in peak regions for sample.
     
+    Returns per-pair arrays (names, ref_ids, positions, mate_positions, tlens).
+    """
     peak_prob = 0.95 if not is_control else 0.05
     
-    if not is_control:
-        for peak_idx, (chrom, peak_start, peak_end) in enumerate(peaks):
-            for i in range(200):
-                read_id = num_reads + peak_idx * 200 + i
-                
-                peak_center = (peak_start + peak_end) // 2
-                peak_width = peak_end - peak_start
-                
-                pos = int(np.random.normal(peak_center, peak_width/6))
-                
-                pos = max(peak_start, min(pos, peak_end - 100))
-                
-                # Shorter fragments for more precise peaks
-                tlen = np.random.randint(50, 100)
-                
-                read1 = pysam.AlignedSegment()
-                read1.query_name = f"peak_read_{read_id}_1"
-                read1.reference_id = next(idx for idx, sq in enumerate(header['SQ']) if sq['SN'] == chrom)
-                read1.reference_start = pos
-                read1.mapping_quality = 60
-                read1.cigartuples = [(0, 75)]  # 75M (75bp match)
-                read1.flag = 99  # Paired, mapped, first in pair
-                
-                mate_pos = pos + tlen - 75
-                chrom_len = header['SQ'][read1.reference_id]['LN']
-                
-                if mate_pos >= chrom_len:
-                    mate_pos = chrom_len - 76
-                
-                if mate_pos > pos:
-                    tlen = mate_pos - pos + 75
-                else:
-                    mate_pos = pos + 1
-                    tlen = 76
-                
-                read1.template_length = tlen
-                read1.next_reference_id = read1.reference_id
-                read1.next_reference_start = mate_pos
-                
-                read2 = pysam.AlignedSegment()
-                read2.query_name = f"peak_read_{read_id}_1"
-                read2.reference_id = read1.reference_id
-                read2.reference_start = mate_pos
-                read2.mapping_quality = 60
-                read2.cigartuples = [(0, 75)]  # 75M (75bp match)
-                read2.flag = 147  # Paired, mapped, second in pair, reverse strand
-                read2.template_length = -tlen
-                read2.next_reference_id = read1.reference_id
-                read2.next_reference_start = read1.reference_start
-                
-                reads.append(read1)
-                reads.append(read2)
-    
-    for i in range(num_reads):
-        in_peak = np.random.random() < peak_prob
-        
-        if in_peak and peaks:
-            peak_idx = np.random.randint(0, len(peaks))
-            chrom, peak_start, peak_end = peaks[peak_idx]
-            
-            peak_center = (peak_start + peak_end) // 2
-            peak_width = peak_end - peak_start
-            pos = int(np.random.normal(peak_center, peak_width/6))
-            
-            pos = max(peak_start, min(pos, peak_end - 100))
-            
-            tlen = np.random.randint(50, 100)  # Shorter fragments for peaks
-        else:
-            chrom_idx = np.random.randint(0, len(header['SQ']))
-            chrom = header['SQ'][chrom_idx]['SN']
-            chrom_len = header['SQ'][chrom_idx]['LN']
-            
-            pos = np.random.randint(1, max(2, chrom_len - 200))
-            tlen = np.random.randint(50, 150)  # Fragment length
-        
-        read1 = pysam.AlignedSegment()
-        read1.query_name = f"read_{i}_1"
-        read1.reference_id = next(idx for idx, sq in enumerate(header['SQ']) if sq['SN'] == chrom)
-        read1.reference_start = pos
-        read1.mapping_quality = 60
-        read1.cigartuples = [(0, 75)]  # 75M (75bp match)
-        read1.flag = 99  # Paired, mapped, first in pair
-        
-        mate_pos = pos + tlen - 75
-        chrom_len = header['SQ'][read1.reference_id]['LN']
-        
-        if mate_pos >= chrom_len:
-            mate_pos = chrom_len - 76
-        
-        if mate_pos > pos:
-            tlen = mate_pos - pos + 75
-        else:
-            mate_pos = pos + 1
-            tlen = 76
-        
-        read1.template_length = tlen
-        read1.next_reference_id = read1.reference_id
-        read1.next_reference_start = mate_pos
-        
-        read2 = pysam.AlignedSegment()
-        read2.query_name = f"read_{i}_1"
-        read2.reference_id = read1.reference_id
-        read2.reference_start = mate_pos
-        read2.mapping_quality = 60
-        read2.cigartuples = [(0, 75)]  # 75M (75bp match)
-        read2.flag = 147  # Paired, mapped, second in pair, reverse strand
-        read2.template_length = -tlen
-        read2.next_reference_id = read1.reference_id
-        read2.next_reference_start = read1.reference_start
-        
-        reads.append(read1)
-        reads.append(read2)
+    bg_names, bg_ref_ids, bg_positions, bg_tlens = _generate_background_reads(
+        rng, num_reads, peaks, peak_prob, header, _BACKGROUND_TLEN_RANGE, _PEAK_TLEN_RANGE)
+    
+    if is_control:
+        names, ref_ids, positions, tlens = bg_names, bg_ref_ids, bg_positions, bg_tlens
+    else:
+        peak_names, peak_ref_ids, peak_positions, peak_tlens = _generate_peak_reads(
+            rng, peaks, _READS_PER_PEAK, header, num_reads, _PEAK_TLEN_RANGE)
+        names = peak_names + bg_names
+        ref_ids = np.concatenate([peak_ref_ids, bg_ref_ids])
+        positions = np.concatenate([peak_positions, bg_positions])
+        tlens = np.concatenate([peak_tlens, bg_tlens])
+    
+    # Place the mate inside the chromosome and downstream of read 1
+    chrom_len = np.array(header.lengths)[ref_ids]
+    mate_positions = positions + tlens - _READ_LEN
+    mate_positions = np.where(mate_positions >= chrom_len, chrom_len - _READ_LEN - 1, mate_positions)
     
-    return reads
+    downstream = mate_positions > positions
+    tlens = np.where(downstream, mate_positions - positions + _READ_LEN, _READ_LEN + 1)
+    mate_positions = np.where(downstream, mate_positions, positions + 1)
+    
+    return names, ref_ids, positions, mate_positions, tlens
+
+def _mirror_pairs(positions, mate_positions, tlens):
+    """Expand per-pair arrays into per-record arrays covering both mates."""
+    starts = np.concatenate([positions, mate_positions])
+    mate_starts = np.concatenate([mate_positions, positions])
+    rec_tlens = np.concatenate([tlens, -tlens])
+    return starts, mate_starts, rec_tlens
 
-def write_bam(reads, header, filename):
-    """Write reads to a BAM file."""
-    reads.sort(key=lambda r: (r.reference_id, r.reference_start))
+def write_bam(reads, header, filename, index=True, threads=None):
+    """Write read pairs to a coordinate-sorted BAM file.
     
-    with pysam.AlignmentFile(filename, "wb", header=header) as outf:
-        for read in reads:
-            outf.write(read)
+    Records are emitted straight into the file in coordinate order, so no
+    list of AlignedSegment objects is built. Returns the number of reads
+    written.
+    """
+    names, ref_ids, positions, mate_positions, tlens = reads
+    num_pairs = len(names)
     
-    pysam.index(filename)
+    # Read 2 mirrors read 1: start and mate start swap, tlen flips sign
+    starts, mate_starts, rec_tlens = _mirror_pairs(positions, mate_positions, tlens)
+    rec_ref_ids = np.concatenate([ref_ids, ref_ids])
     
-    return filename
+    # Sort on a packed (ref_id, start) key; index k < num_pairs is read 1
+    # of pair k, otherwise read 2 of pair k - num_pairs
+    keys = (rec_ref_ids.astype(np.int64) << 32) | starts
+    order = np.argsort(keys, kind='stable')
+    
+    rec_names = np.array(names, dtype=object)[order % num_pairs].tolist()
+    rec_flags = np.where(order < num_pairs, _FLAG_READ1, _FLAG_READ2)
+    chroms = header.references
+    
+    # Let htslib spread BGZF compression over the available cores; the
+    # files are throwaway fixtures, so favour speed over size (level 1)
+    if threads is None:
+        threads = os.cpu_count() or 4
+    
+    fixed_fields = f"\t{_MAPQ}\t{_CIGAR}\t=\t"
+    
+    with pysam.AlignmentFile(filename, "wb", header=header, threads=threads,
+                             format_options=[b"level=1"]) as outf:
+        for qname, flag, tid, pos, mate_pos, tlen in zip(rec_names, rec_flags.tolist(), rec_ref_ids[order].tolist(),
+                                                         starts[order].tolist(), mate_starts[order].tolist(),
+                                                         rec_tlens[order].tolist()):
+            line = f"{qname}\t{flag}\t{chroms[tid]}\t{pos + 1}{fixed_fields}{mate_pos + 1}\t{tlen}\t*\t*"
+            outf.write(pysam.AlignedSegment.fromstring(line, header))
+    
+    if index:
+        pysam.index("-@", str(threads), filename)
+    
+    return 2 * num_pairs
+
+def generate_bam(num_reads, peaks, header, seed, filename, is_control=False, index=True, threads=None):
+    """Generate reads and write them to a BAM file in a worker process.
+    
+    Takes the header as a dict and the seed as a SeedSequence so the
+    arguments can be pickled. threads is the htslib thread count for
+    this worker. Returns the number of reads written.
+    """
+    header = pysam.AlignmentHeader.from_dict(header)
+    rng = np.random.default_rng(seed)
+    reads = generate_reads(num_reads, peaks, header, rng, is_control=is_control)
+    return write_bam(reads, header, filename, index=index, threads=threads)
 
 def main():
     args = parse_args()
     
-    header = create_header()
-    peaks = generate_peak_regions(args.peaks, header)
+    # Always record the seed used, so that unseeded runs can be reproduced too
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy)
+    seed_seq = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seed_seq)
+    command_line = f"generate_test_data.py --reads {args.reads} --peaks {args.peaks} --seed {seed}"
+    
+    sample_command_line = f"{command_line} --role sample"
+    control_command_line = f"{command_line} --role control"
+    
+    header = pysam.AlignmentHeader.from_dict(create_header())
+    peaks = generate_peak_regions(args.peaks, header, rng)
     
-    sample_reads = generate_reads(args.reads, peaks, header, is_control=False)
-    sample_bam = write_bam(sample_reads, header, args.output)
+    # A seeded run is deterministic, so on request BAMs left by an identical
+    # earlier run can be reused
+    cached = (args.reuse and args.seed is not None
+              and is_cached(args.output, sample_command_line, index=args.index)
+              and is_cached(args.control, control_command_line, index=args.index))
     
-    control_reads = generate_reads(args.reads, peaks, header, is_control=True)
-    control_bam = write_bam(control_reads, header, args.control)
+    if not cached:
+        # Sample and control are independent, so build them in parallel,
+        # each from its own child seed to keep the two streams distinct
+        sample_seed, control_seed = seed_seq.spawn(2)
+        # Split the cores between the two workers rather than oversubscribing
+        threads = max(1, (os.cpu_count() or 2) // 2)
+        with multiprocessing.Pool(2) as pool:
+            num_sample_reads, num_control_reads = pool.starmap(generate_bam, [
+                (args.reads, peaks, create_header(sample_command_line), sample_seed, args.output, False, args.index, threads),
+                (args.reads, peaks, create_header(control_command_line), control_seed, args.control, True, args.index, threads),
+            ])
     
     with open("test_true_peaks.bed", "w") as f:
-        for i, (chrom, start, end) in enumerate(peaks):
-            f.write(f"{chrom}\t{start}\t{end}\tpeak_{i}\t1000\t.\n")
+        f.write("".join(f"{chrom}\t{start}\t{end}\tpeak_{i}\t1000\t.\n"
+                        for i, (chrom, start, end) in enumerate(peaks)))
     
-    print(f"Generated {len(sample_reads)} reads in sample BAM: {args.output}")
-    print(f"Generated {len(control_reads)} reads in control BAM: {args.control}")
+    if cached:
+        print(f"Reusing sample BAM: {args.output} and control BAM: {args.control} (seed {seed})")
+    else:
+        print(f"Generated {num_sample_reads} reads in sample BAM: {args.output} (seed {seed})")
+        print(f"Generated {num_control_reads} reads in control BAM: {args.control}")
     print(f"Generated {len(peaks)} true peaks in: test_true_peaks.bed")
 
 if __name__ == "__main__":